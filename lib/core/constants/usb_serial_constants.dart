@@ -21,6 +21,19 @@ class UsbSerialConstants {
   static const int msgTypeHeartbeat = 0x04;
   static const int msgTypePushState = 0x05;
 
+  /// Link handshake (optional): data = "baud1,baud2,...|feature1,feature2,..."
+  static const int msgTypeLinkCaps = 0x07;
+
+  /// Link speed switch: data = target baud; micro echoes the accepted rate
+  /// (or its current one if refused) at the old rate, then switches.
+  static const int msgTypeLinkSwitch = 0x08;
+
+  /// Baud rates offered in the link handshake; every session starts at [defaultBaudRate]
+  static const List<int> supportedBaudRates = [9600, 19200, 38400, 57600, 115200];
+
+  /// No valid frame this long after a switch → both sides fall back to [defaultBaudRate]
+  static const int linkSwitchTimeout = 2000; // 2 seconds
+
   // Heartbeat interval (milliseconds)
   static const int heartbeatInterval = 1000; // 1 second
 
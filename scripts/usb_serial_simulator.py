@@ -8,6 +8,9 @@
 
   2) کلاینت تست: روی پورت دیگر (جفت مجازی) درخواست می‌فرستد و پاسخ شبیه‌ساز را چک می‌کند.
      python usb_serial_simulator.py --test COM6
+     با مذاکرهٔ سرعت خط (بالاترین baud مشترک، برگشت خودکار به 9600 در صورت خطا):
+     python usb_serial_simulator.py --test COM6 --negotiate
+     هر دو حالت baud اولیه را با --baud می‌گیرند (پیش‌فرض 9600).
 
   3) لیست پورت‌ها: نمایش پورت‌های سریال موجود.
      python usb_serial_simulator.py --list
@@ -16,6 +19,22 @@
      python usb_serial_simulator.py --tcp 9999
      سپس روی لپ‌تاپ: adb reverse tcp:9999 tcp:9999
      در اپ روی تبلت گزینه «اتصال دیباگ» را بزنید.
+     چند تبلت هم‌زمان با زمان‌بندی منصفانه؛ محدودیت نرخ/وزن هر کلاینت (فریم در ثانیه):
+     python usb_serial_simulator.py --tcp 9999 --rate 20 --client 192.168.1.20=2:50
+
+  5) gateway: چند تبلت TCP روی یک خط سریال (پورت واقعی یا بدون پورت = شبیه‌ساز داخلی):
+     python usb_serial_simulator.py --gateway 9999 COM5
+     python usb_serial_simulator.py --gateway 9999 --cache-ttl 1
+     خواندن‌های یکسانِ هم‌زمان یک درخواست روی خط می‌شوند و پاسخ‌ها تا --cache-ttl ثانیه از cache داده می‌شوند.
+
+  6) بنچمارک مسیر نوشتن (تعداد write در هر درخواست و تأخیر ورودی در حین پاسخ بزرگ):
+     python usb_serial_simulator.py --bench 200
+     بنچمارک عدالت بین کلاینت‌ها (یک تبلت پرحجم + چند تبلت عادی):
+     python usb_serial_simulator.py --bench-fair 5
+     زمان انتقال برای هر baud بعد از مذاکره، روی جفت pty با نرخ خط شبیه‌سازی‌شده (Linux/macOS):
+     python usb_serial_simulator.py --bench-baud 5
+     تعداد درخواست‌هایی که از gateway روی خط سریال می‌روند:
+     python usb_serial_simulator.py --bench-gateway 6
 
 فرمت متن (بدون JSON): جداکننده فیلد | ، هر رکورد یک خط.
 - طبقات: هر خط = id|name|order|roomIds (roomIds با کاما)
@@ -24,9 +43,16 @@
 نیاز: pip install pyserial
 """
 
+import contextlib
+import io
+import os
+import queue
+import select
 import socket
 import sys
+import threading
 import time
+from collections import deque
 
 try:
     import serial
@@ -39,10 +65,14 @@ except ImportError:
 STX = 0x02
 ETX = 0x03
 ACK = 0x06
+NAK = 0x15
 MSG_TYPE_COMMAND = 0x01
 MSG_TYPE_REQUEST = 0x02
 MSG_TYPE_RESPONSE = 0x03
 MSG_TYPE_HEARTBEAT = 0x04
+MSG_TYPE_PUSH_STATE = 0x05
+MSG_TYPE_LINK_CAPS = 0x07
+MSG_TYPE_LINK_SWITCH = 0x08
 REQUEST_FLOORS = "@M_F_A"
 REQUEST_FLOORS_COUNT = "@M_F_C"
 REQUEST_ROOMS = "@M_R"
@@ -56,6 +86,34 @@ FIELD_SEP = "|"
 RECORD_SEP = "\n"
 LIST_SEP = ","
 
+# مذاکرهٔ سرعت خط بعد از اتصال (MSG_TYPE_LINK_CAPS / MSG_TYPE_LINK_SWITCH)
+DEFAULT_BAUD = 9600
+SUPPORTED_BAUD_RATES = (9600, 19200, 38400, 57600, 115200)
+# نام قابلیت‌ها در LinkCaps؛ فرمت فریم هنوز هیچ‌کدام را پیاده نکرده، پس به‌طور پیش‌فرض هیچ قابلیتی اعلام نمی‌شود
+FEATURE_EXT_LENGTH = "extlen"
+FEATURE_COMPRESSION = "zlib"
+FEATURE_WINDOWING = "window"
+LINK_SWITCH_TIMEOUT = 2.0  # ثانیه؛ بدون فریم معتبر بعد از تغییر baud → برگشت به DEFAULT_BAUD
+
+# صف خروجی هر اتصال: بالای HIGH ورودی جدید پردازش نمی‌شود تا صف به زیر LOW برسد (بایت)
+OUTPUT_HIGH_WATERMARK = 4096
+OUTPUT_LOW_WATERMARK = 1024
+OUTPUT_WRITE_TIMEOUT = 2.0  # ثانیه بدون پیشرفت در ارسال (کلاینت نمی‌خواند) → اتصال خراب فرض می‌شود
+
+# زمان‌بندی کلاینت‌های TCP (deficit round-robin، بخش _FairScheduler)
+MAX_TCP_CLIENTS = 8
+SCHED_QUANTUM = 256  # بایت فریم در هر نوبت، ضرب در وزن کلاینت
+SCHED_MAX_QUEUE = 32  # با این تعداد فریم در صف، خواندن از آن کلاینت متوقف می‌شود
+SCHED_RATE_BURST = 5  # حداکثر token ذخیره در محدودیت نرخ
+SCHED_REPORT_INTERVAL = 10.0  # ثانیه
+
+# حالت gateway: چند تبلت TCP روی یک خط سریال
+GATEWAY_CACHE_TTL = 1.0  # ثانیه؛ 0 = بدون cache (فقط ادغام خواندن‌های هم‌زمان)
+GATEWAY_UPSTREAM_TIMEOUT = 2.0  # انتظار برای ACK/Response میکرو (مثل ackTimeout اپ)
+GATEWAY_UPSTREAM_HEARTBEAT = 1.0  # ثانیه بدون بایت از میکرو → gateway خودش heartbeat می‌فرستد (heartbeatInterval اپ)
+GATEWAY_UPSTREAM_ALIVE = 5.0  # heartbeat تبلت فقط اگر میکرو در این مدت جواب داده ACK می‌شود (connectionTimeout اپ)
+GATEWAY_ACK_ONLY_WINDOW = 0.5  # ثانیه؛ بعد از ACK خواندن، اگر بایتی از میکرو نرسد درخواست فقط-ACK است و خط آزاد می‌شود
+
 
 def _floor_to_line(f):
     """id|name|order|roomIds"""
@@ -113,14 +171,30 @@ def encode_frame(msg_type: int, data: str) -> bytes:
     return bytes([STX, msg_type, length]) + data_bytes + bytes([checksum, ETX])
 
 
+def encode_link_caps(bauds, features) -> str:
+    """CAPS: baud1,baud2,...|feature1,feature2,..."""
+    return f"{LIST_SEP.join(str(b) for b in bauds)}{FIELD_SEP}{LIST_SEP.join(features)}"
+
+
+def parse_link_caps(data: str):
+    bauds_text, _, features_text = data.partition(FIELD_SEP)
+    bauds = [int(x) for x in bauds_text.split(LIST_SEP) if x.strip().isdigit()]
+    features = [x.strip() for x in features_text.split(LIST_SEP) if x.strip()]
+    return bauds, features
+
+
 def send_ack(ser):
     ser.write(bytes([STX, ACK, ETX]))
 
 
+def send_nak(ser):
+    ser.write(bytes([STX, NAK, ETX]))
+
+
 def find_frame(buf: bytearray):
     """
     پیدا کردن اولین فریم کامل.
-    برگشت: (msg_type, data_str) یا ("ack", "") برای ACK/NAK؛ یا None و بافر جدید.
+    برگشت: (msg_type, data_str) یا ("ack", "") / ("nak", "") برای ACK/NAK؛ یا None و بافر جدید.
     """
     start = -1
     for i in range(len(buf)):
@@ -133,8 +207,10 @@ def find_frame(buf: bytearray):
     # ACK/NAK: [STX, control, ETX]
     if start + 3 <= len(buf) and buf[start + 2] == ETX:
         control = buf[start + 1]
-        if control == ACK or control == 0x15:
+        if control == ACK:
             return ("ack", ""), buf[start + 3 :]
+        if control == NAK:
+            return ("nak", ""), buf[start + 3 :]
 
     if start + 3 > len(buf):
         return None, buf[start:]
@@ -284,6 +360,8 @@ class _TcpTransport:
 
     def __init__(self, sock):
         self._sock = sock
+        # یک بار تنظیم شود؛ writer در thread جدا روی همین socket می‌نویسد
+        self._sock.settimeout(0.1)
 
     def write(self, data: bytes):
         try:
@@ -292,10 +370,36 @@ class _TcpTransport:
             print(f"[SIM] ⚠️ Write failed (connection closed?): {e}")
             raise  # دوباره raise کن تا loop بدونه اتصال بسته شده
 
+    def writev(self, chunks):
+        """Vectored write: all chunks go out in one sendmsg (repeated only after a partial send)."""
+        if not hasattr(self._sock, "sendmsg"):
+            # ویندوز sendmsg ندارد؛ یک sendall با بایت‌های به‌هم‌چسبیده
+            self.write(b"".join(chunks))
+            return
+        views = [memoryview(c) for c in chunks if c]
+        deadline = time.monotonic() + OUTPUT_WRITE_TIMEOUT
+        try:
+            while views:
+                try:
+                    sent = self._sock.sendmsg(views)
+                except socket.timeout:
+                    # بافر ارسال پر است؛ تا deadline دوباره تلاش کن، بعد writer با خطا متوقف شود
+                    if time.monotonic() >= deadline:
+                        raise
+                    continue
+                deadline = time.monotonic() + OUTPUT_WRITE_TIMEOUT
+                while views and sent >= len(views[0]):
+                    sent -= len(views[0])
+                    views.pop(0)
+                if views and sent:
+                    views[0] = views[0][sent:]
+        except (ConnectionResetError, BrokenPipeError, OSError) as e:
+            print(f"[SIM] ⚠️ Write failed (connection closed?): {e}")
+            raise
+
     def read(self, size: int = 256) -> bytes:
         try:
-            self._sock.settimeout(0.1)
-            return self._sock.recv(size)
+            data = self._sock.recv(size)
         except socket.timeout:
             return b""
         except (ConnectionResetError, BrokenPipeError, OSError) as e:
@@ -304,6 +408,399 @@ class _TcpTransport:
         except Exception as e:
             print(f"[SIM] ⚠️ Read error: {e}")
             return b""
+        if not data:
+            # recv خالی بدون timeout یعنی طرف مقابل اتصال را بسته است
+            raise ConnectionResetError("connection closed by peer")
+        return data
+
+
+class _OutputQueue:
+    """
+    صف خروجی یک اتصال.
+    فریم‌هایی که هنگام پردازش ورودی تولید می‌شوند (ACK + پاسخ و هر فریم push) جمع می‌شوند و با flush()
+    در یک write برداری (writev) فرستاده می‌شوند. نوشتن در thread جدا انجام می‌شود تا خواندن در حین
+    تخلیهٔ پاسخ‌های بزرگ (مثلاً ۹۶۰۰ baud) ادامه پیدا کند. بالای high watermark، paused=True می‌شود و
+    تا رسیدن به زیر low watermark خواننده نباید فریم جدید بپذیرد.
+    threaded=False: بدون writer؛ flush() همان‌جا (blocking) می‌نویسد.
+    per_frame=True: رفتار قبل از صف؛ هر فریم همان‌جا با یک write جدا نوشته می‌شود (برای مقایسه در بنچمارک).
+    """
+
+    def __init__(self, transport, high=OUTPUT_HIGH_WATERMARK, low=OUTPUT_LOW_WATERMARK, threaded=True, per_frame=False):
+        self._transport = transport
+        self._per_frame = per_frame
+        self._high = high
+        self._low = low
+        self._chunks = []
+        self._pending = 0  # بایت‌های در صف + در حال نوشتن
+        self._paused = False
+        self._kick = False
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = None
+        if threaded and not per_frame:
+            self._thread = threading.Thread(target=self._writer, name="sim-writer", daemon=True)
+            self._thread.start()
+
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def write(self, data: bytes):
+        """Queue a frame; nothing is written until flush()."""
+        if self._per_frame:
+            self._transport.write(data)
+            return
+        with self._cond:
+            self._raise_if_failed()
+            self._chunks.append(data)
+            self._pending += len(data)
+            if self._pending >= self._high:
+                self._paused = True
+
+    def flush(self):
+        """Hand everything queued so far to the writer as one vectored write."""
+        if self._thread is None:
+            with self._cond:
+                chunks = self._take()
+            if chunks:
+                self._write_chunks(chunks)
+            return
+        with self._cond:
+            self._raise_if_failed()
+            if self._chunks:
+                self._kick = True
+                self._cond.notify_all()
+
+    def wait_resumed(self, timeout: float):
+        """Block until the queue drains below the low watermark (or timeout)."""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._paused or self._error is not None, timeout)
+            self._raise_if_failed()
+
+    def drain(self, timeout: float):
+        """Block until everything flushed so far has been written (or timeout)."""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending == 0 or self._error is not None, timeout)
+
+    def close(self, timeout: float = 2.0):
+        """Stop the writer after it drains what is already flushed."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+    def _take(self):
+        chunks, self._chunks = self._chunks, []
+        self._kick = False
+        return chunks
+
+    def _write_chunks(self, chunks):
+        try:
+            if hasattr(self._transport, "writev"):
+                self._transport.writev(chunks)
+            else:
+                # pyserial writev ندارد؛ یک بار write با بایت‌های به‌هم‌چسبیده
+                self._transport.write(b"".join(chunks))
+        finally:
+            with self._cond:
+                self._pending -= sum(len(c) for c in chunks)
+                if self._paused and self._pending <= self._low:
+                    self._paused = False
+                self._cond.notify_all()
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._kick or self._closed)
+                if not self._kick:
+                    return
+                chunks = self._take()
+            try:
+                self._write_chunks(chunks)
+            except Exception as e:
+                if not isinstance(e, OSError):
+                    print(f"[SIM] ⚠️ Writer stopped: {e!r}")
+                with self._cond:
+                    # خطا در write بعدی/flush بعدی در loop خواننده raise می‌شود
+                    self._error = e
+                    self._chunks = []
+                    self._paused = False
+                    self._cond.notify_all()
+                return
+
+
+SCHED_INTERACTIVE = 0  # heartbeat و درخواست‌های خواندن (@...)
+SCHED_BULK = 1  # دستورات نوشتن (&...)
+
+
+def _sched_class(msg_type) -> int:
+    return SCHED_BULK if msg_type == MSG_TYPE_COMMAND else SCHED_INTERACTIVE
+
+
+class _SchedClient:
+    """صف‌ها، وزن، محدودیت نرخ و آمار یک کلاینت در _FairScheduler."""
+
+    def __init__(self, name: str, out, weight: float, rate):
+        # وزن صفر/منفی quantum مثبت نمی‌دهد و _pick هرگز از حلقهٔ deficit بیرون نمی‌آید
+        assert weight > 0, f"{name}: weight must be > 0"
+        assert rate is None or rate > 0, f"{name}: rate must be > 0"
+        self.name = name
+        self.out = out
+        self.weight = weight
+        self.rate = rate  # فریم در ثانیه (بدون heartbeat)؛ None = بدون محدودیت
+        self.tokens = float(SCHED_RATE_BURST)
+        self.refilled_at = time.monotonic()
+        self.queues = (deque(), deque())  # به ترتیب SCHED_INTERACTIVE و SCHED_BULK
+        self.deficits = [0.0, 0.0]
+        self.served = [0, 0]
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.limited = 0  # فریم‌هایی که به‌خاطر محدودیت نرخ منتظر ماندند
+        self.throttled = [None, None]  # آخرین فریم شمرده‌شده در limited برای هر کلاس
+
+    @property
+    def depth(self) -> int:
+        return len(self.queues[0]) + len(self.queues[1])
+
+    @property
+    def backlogged(self) -> bool:
+        return self.depth >= SCHED_MAX_QUEUE
+
+    def take_token(self, now: float) -> bool:
+        if self.rate is None:
+            return True
+        self.tokens = min(float(SCHED_RATE_BURST), self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def report(self) -> str:
+        served = self.served[0] + self.served[1]
+        avg_ms = self.wait_total / served * 1000 if served else 0.0
+        return (
+            f"{self.name} depth={self.depth} max={self.max_depth} "
+            f"served={served} (read/hb={self.served[0]} write={self.served[1]}) "
+            f"wait avg={avg_ms:.1f}ms max={self.wait_max * 1000:.1f}ms limited={self.limited}"
+        )
+
+
+class _FairScheduler:
+    """
+    زمان‌بندی فریم‌های چند کلاینت TCP برای یک کنترلر (یک worker).
+    هر کلاینت دو صف دارد: خواندن/heartbeat و نوشتن. صف‌های خواندن قبل از نوشتن سرویس می‌گیرند (جز خواندنی که
+    بعد از نوشتنِ هنوز در صفِ همان کلاینت آمده؛ heartbeatهای پشت چنین خواندنی منتظر آن نمی‌مانند) و
+    داخل هر کلاس بین کلاینت‌ها deficit round-robin با quantum = SCHED_QUANTUM × وزن (بایت فریم) اجرا می‌شود؛
+    پس یک تبلت که room_setup_flow اجرا می‌کند فقط سهم خودش را از نوشتن‌ها می‌گیرد.
+    rate: محدودیت نرخ هر کلاینت (فریم در ثانیه، heartbeat شامل نمی‌شود)؛ overrides: {ip: (weight, rate)}.
+    """
+
+    def __init__(self, weight: float = 1.0, rate=None, overrides=None):
+        self._weight = weight
+        self._rate = rate
+        self._overrides = overrides or {}
+        self._cond = threading.Condition()
+        self._clients = []
+        self._active = (deque(), deque())  # ترتیب round-robin کلاینت‌های دارای صف در هر کلاس
+
+    def add_client(self, name: str, out) -> _SchedClient:
+        weight, rate = self._overrides.get(name.rsplit(":", 1)[0], (self._weight, self._rate))
+        client = _SchedClient(name, out, weight, rate)
+        with self._cond:
+            self._clients.append(client)
+        return client
+
+    def remove_client(self, client: _SchedClient):
+        with self._cond:
+            if client in self._clients:
+                self._clients.remove(client)
+            for active in self._active:
+                if client in active:
+                    active.remove(client)
+            client.queues[0].clear()
+            client.queues[1].clear()
+            self._cond.notify_all()
+
+    def submit(self, client: _SchedClient, msg_type, data: str):
+        cls = _sched_class(msg_type)
+        cost = len(data.encode("utf-8")) + 5  # طول کل فریم
+        with self._cond:
+            q = client.queues[cls]
+            if not q:
+                self._active[cls].append(client)
+            q.append((time.monotonic(), msg_type, data, cost))
+            client.max_depth = max(client.max_depth, client.depth)
+            self._cond.notify_all()
+
+    def wait_ready(self, client: _SchedClient, timeout: float):
+        """Block a reader while its client has SCHED_MAX_QUEUE frames waiting."""
+        with self._cond:
+            self._cond.wait_for(lambda: not client.backlogged, timeout)
+
+    def next(self, timeout: float):
+        """Next frame to serve as (client, msg_type, data), or None after timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                for cls in (SCHED_INTERACTIVE, SCHED_BULK):
+                    item = self._pick(cls, now)
+                    if item is not None:
+                        self._cond.notify_all()  # خواننده‌ای که به‌خاطر صف پر متوقف بود
+                        return item
+                remaining = deadline - now
+                if remaining <= 0:
+                    return None
+                # اگر فقط کلاینت‌های محدودشده صف دارند، بعد از پر شدن token دوباره تلاش کن
+                self._cond.wait(min(remaining, 0.05))
+
+    def _pick(self, cls: int, now: float):
+        active = self._active[cls]
+        skips = 0
+        while active and skips < len(active):
+            client = active[0]
+            q = client.queues[cls]
+            if not q:
+                active.popleft()
+                client.deficits[cls] = 0.0
+                continue
+            index = 0
+            item = q[0]
+            enqueued_at, msg_type, data, cost = item
+            bulk = client.queues[SCHED_BULK]
+            if msg_type == MSG_TYPE_REQUEST and cls == SCHED_INTERACTIVE and bulk and bulk[0][0] < enqueued_at:
+                # خواندن یک کلاینت از دستور نوشتنِ قبلی خودش جلو نمی‌زند (وگرنه دادهٔ قدیمی می‌گیرد)؛
+                # ولی heartbeat پشت آن منتظر نمی‌ماند تا ackTimeout اپ نگذرد
+                index = next((i for i, queued in enumerate(q) if queued[1] == MSG_TYPE_HEARTBEAT), None)
+                if index is None:
+                    active.rotate(-1)
+                    skips += 1
+                    continue
+                item = q[index]
+                enqueued_at, msg_type, data, cost = item
+            if client.deficits[cls] < cost:
+                client.deficits[cls] += SCHED_QUANTUM * client.weight
+                active.rotate(-1)
+                skips = 0
+                continue
+            if msg_type != MSG_TYPE_HEARTBEAT and not client.take_token(now):
+                if client.throttled[cls] is not item:
+                    # next() هر ۵۰ms دوباره تلاش می‌کند؛ هر فریم فقط یک بار شمرده شود
+                    client.throttled[cls] = item
+                    client.limited += 1
+                active.rotate(-1)
+                skips += 1
+                continue
+            del q[index]
+            client.deficits[cls] -= cost
+            if not q:
+                active.popleft()
+                client.deficits[cls] = 0.0
+            waited = now - enqueued_at
+            client.served[cls] += 1
+            client.wait_total += waited
+            client.wait_max = max(client.wait_max, waited)
+            return client, msg_type, data
+        return None
+
+    def report(self):
+        """One line per connected client: queue depth, served frames and wait time."""
+        with self._cond:
+            return [client.report() for client in self._clients]
+
+
+def _controller_worker(scheduler: _FairScheduler, stop: threading.Event, service_time: float = 0.0):
+    """The single 'micro': serves scheduled frames one at a time and reports per-client stats every SCHED_REPORT_INTERVAL."""
+    next_report = time.monotonic() + SCHED_REPORT_INTERVAL
+    while not stop.is_set():
+        item = scheduler.next(0.2)
+        if item is not None:
+            client, msg_type, data = item
+            if service_time:
+                time.sleep(service_time)
+            try:
+                _dispatch_frame(client.out, msg_type, data)
+                client.out.flush()
+            except (ConnectionResetError, BrokenPipeError, OSError) as e:
+                print(f"[SIM] ⚠️ {client.name}: response dropped, connection closed: {e}")
+            except Exception as e:
+                print(f"[SIM] ⚠️ {client.name}: error handling frame (continuing): {e}")
+        if time.monotonic() >= next_report:
+            next_report = time.monotonic() + SCHED_REPORT_INTERVAL
+            for line in scheduler.report():
+                print(f"[SCHED] {line}")
+
+
+class _LinkSession:
+    """
+    سمت میکرو در مذاکرهٔ سرعت خط.
+    CAPS: نرخ‌ها و قابلیت‌های خودش را برمی‌گرداند. SWITCH: ACK + تأیید نرخ (هنوز با سرعت قبلی)، تخلیهٔ خروجی
+    و سپس تغییر baud. اگر تا LINK_SWITCH_TIMEOUT بعد از تغییر هیچ فریم معتبری نرسد به DEFAULT_BAUD برمی‌گردد.
+    transport بدون baudrate (مثلاً TCP) فقط نرخ فعلی را اعلام می‌کند.
+    """
+
+    def __init__(self, transport, out, bauds=SUPPORTED_BAUD_RATES, features=()):
+        self._transport = transport
+        self._out = out
+        self._can_switch = hasattr(transport, "baudrate")
+        self.baud = transport.baudrate if self._can_switch else DEFAULT_BAUD
+        self.bauds = sorted(bauds) if self._can_switch else [self.baud]
+        self.features = list(features)
+        self.common_features = []
+        self._probation_until = None
+
+    def handle(self, msg_type, data: str):
+        send_ack(self._out)
+        if msg_type == MSG_TYPE_LINK_CAPS:
+            peer_bauds, peer_features = parse_link_caps(data)
+            self.common_features = [f for f in self.features if f in peer_features]
+            self._out.write(encode_frame(MSG_TYPE_LINK_CAPS, encode_link_caps(self.bauds, self.features)))
+            print(f"[SIM] 🔗 LINK caps peer={peer_bauds} common features={self.common_features}")
+            return
+        baud = int(data) if data.strip().isdigit() else 0
+        if baud not in self.bauds or baud == self.baud:
+            # رد درخواست: نرخ فعلی را برمی‌گرداند
+            self._out.write(encode_frame(MSG_TYPE_LINK_SWITCH, str(self.baud)))
+            print(f"[SIM] 🔗 LINK switch to {data!r} refused, staying at {self.baud}")
+            return
+        self._out.write(encode_frame(MSG_TYPE_LINK_SWITCH, str(baud)))
+        self._set_baud(baud)
+        if baud != DEFAULT_BAUD:
+            self._probation_until = time.monotonic() + LINK_SWITCH_TIMEOUT
+
+    def frame_ok(self):
+        """A valid frame arrived: the current rate works."""
+        self._probation_until = None
+
+    def check(self):
+        if self._probation_until is not None and time.monotonic() > self._probation_until:
+            self._probation_until = None
+            print(f"[SIM] ⚠️ LINK no valid frame at {self.baud} baud, falling back to {DEFAULT_BAUD}")
+            self._set_baud(DEFAULT_BAUD)
+
+    def _set_baud(self, baud: int):
+        # تأیید باید قبل از تغییر نرخ کامل روی خط رفته باشد
+        self._out.flush()
+        self._out.drain(LINK_SWITCH_TIMEOUT)
+        if hasattr(self._transport, "flush"):
+            self._transport.flush()
+        self._transport.baudrate = baud
+        self.baud = baud
+        print(f"[SIM] 🔗 LINK baud -> {baud}")
 
 
 def _req_name(data: str) -> str:
@@ -329,64 +826,94 @@ def _req_name(data: str) -> str:
     return data[:40] if len(data) > 40 else data
 
 
-def _run_simulator_loop(transport, label="Serial"):
-    """Shared loop: read from transport, handle frames, write responses. transport must have write(data) and read(size)."""
+def _dispatch_frame(out, msg_type, data: str):
+    """Handle one frame from the client. ACK and response are queued on `out` (the caller flushes)."""
+    if msg_type == MSG_TYPE_HEARTBEAT:
+        send_ack(out)
+        # بدون لاگ تا ترمینال شلوغ نشود؛ اتصال زنده می‌ماند
+    elif msg_type == MSG_TYPE_REQUEST and data == REQUEST_FLOORS:
+        send_ack(out)
+        body = get_floors_text()
+        out.write(encode_frame(MSG_TYPE_RESPONSE, body))
+        lines = body.strip().split(RECORD_SEP) if body.strip() else []
+        print(f"[SIM] 📤 TX RESPONSE requestFloors count={len(lines)} | {body[:50]}...")
+    elif msg_type == MSG_TYPE_REQUEST and data == REQUEST_FLOORS_COUNT:
+        send_ack(out)
+        body = str(len(FLOORS_LIST))
+        out.write(encode_frame(MSG_TYPE_RESPONSE, body))
+        print(f"[SIM] 📤 TX RESPONSE requestFloorsCount value={body}")
+    elif msg_type == MSG_TYPE_REQUEST and data == REQUEST_ROOMS:
+        send_ack(out)
+        body = get_rooms_text()
+        out.write(encode_frame(MSG_TYPE_RESPONSE, body))
+        lines = body.strip().split(RECORD_SEP) if body.strip() else []
+        print(f"[SIM] 📤 TX RESPONSE requestRooms count={len(lines)} | {body[:50]}...")
+    elif msg_type == MSG_TYPE_COMMAND:
+        send_ack(out)
+        print(f"[SIM] 📤 TX ACK command")
+        _handle_command(out, data)
+    elif msg_type == MSG_TYPE_REQUEST:
+        send_ack(out)
+        print(f"[SIM] 📤 TX ACK only (unknown request)")
+
+
+def _run_simulator_loop(transport, label="Serial", writer="thread", scheduler=None):
+    """
+    Shared loop: read from transport, handle frames, queue responses. transport must have write(data) and read(size).
+    همهٔ فریم‌های خروجی یک دور خواندن (ACK + پاسخ‌ها) از طریق _OutputQueue در یک write فرستاده می‌شوند.
+    writer: "thread" (پیش‌فرض)، "inline" (flush بدون thread) یا "frame" (هر فریم یک write؛ فقط برای بنچمارک).
+    با scheduler (حالت TCP چندکلاینتی) فریم‌ها به‌جای پاسخ مستقیم به _FairScheduler سپرده می‌شوند.
+    """
     buf = bytearray()
+    out = _OutputQueue(transport, threaded=writer == "thread", per_frame=writer == "frame")
+    client = scheduler.add_client(label, out) if scheduler is not None else None
+    link = _LinkSession(transport, out)
     try:
         while True:
             try:
+                if out.paused:
+                    # backpressure: تا تخلیهٔ صف خروجی تا low watermark، ورودی جدید خوانده نمی‌شود
+                    out.wait_resumed(0.1)
+                    continue
+                if client is not None and client.backlogged:
+                    # سهم این کلاینت در صف کنترلر پر است؛ تا خالی شدن از آن نخوان
+                    scheduler.wait_ready(client, 0.1)
+                    continue
+                link.check()
                 chunk = transport.read(256)
                 if chunk:
                     buf.extend(chunk)
-                while True:
+                while not out.paused and not (client is not None and client.backlogged):
                     result, buf = find_frame(buf)
                     if result is None:
                         break
                     msg_type, data = result
-                    if msg_type == "ack":
+                    if msg_type in ("ack", "nak"):
                         continue
                     type_name = {
                         MSG_TYPE_REQUEST: "REQUEST",
                         MSG_TYPE_COMMAND: "COMMAND",
                         MSG_TYPE_RESPONSE: "RESPONSE",
                         MSG_TYPE_HEARTBEAT: "HEARTBEAT",
+                        MSG_TYPE_LINK_CAPS: "LINK_CAPS",
+                        MSG_TYPE_LINK_SWITCH: "LINK_SWITCH",
                     }.get(msg_type, str(msg_type))
                     name = _req_name(data)
                     preview = f"{data[:60]}{'...' if len(data) > 60 else ''}"
                     if msg_type != MSG_TYPE_HEARTBEAT:
                         print(f"[SIM] 📥 RX {type_name} {name} | {preview}")
-                try:
-                    if msg_type == MSG_TYPE_HEARTBEAT:
-                        send_ack(transport)
-                        # بدون لاگ تا ترمینال شلوغ نشود؛ اتصال زنده می‌ماند
-                    elif msg_type == MSG_TYPE_REQUEST and data == REQUEST_FLOORS:
-                        send_ack(transport)
-                        body = get_floors_text()
-                        transport.write(encode_frame(MSG_TYPE_RESPONSE, body))
-                        lines = body.strip().split(RECORD_SEP) if body.strip() else []
-                        print(f"[SIM] 📤 TX RESPONSE requestFloors count={len(lines)} | {body[:50]}...")
-                    elif msg_type == MSG_TYPE_REQUEST and data == REQUEST_FLOORS_COUNT:
-                        send_ack(transport)
-                        body = str(len(FLOORS_LIST))
-                        transport.write(encode_frame(MSG_TYPE_RESPONSE, body))
-                        print(f"[SIM] 📤 TX RESPONSE requestFloorsCount value={body}")
-                    elif msg_type == MSG_TYPE_REQUEST and data == REQUEST_ROOMS:
-                        send_ack(transport)
-                        body = get_rooms_text()
-                        transport.write(encode_frame(MSG_TYPE_RESPONSE, body))
-                        lines = body.strip().split(RECORD_SEP) if body.strip() else []
-                        print(f"[SIM] 📤 TX RESPONSE requestRooms count={len(lines)} | {body[:50]}...")
-                    elif msg_type == MSG_TYPE_COMMAND:
-                        send_ack(transport)
-                        print(f"[SIM] 📤 TX ACK command")
-                        _handle_command(transport, data)
-                    elif msg_type == MSG_TYPE_REQUEST:
-                        send_ack(transport)
-                        print(f"[SIM] 📤 TX ACK only (unknown request)")
-                except (ConnectionResetError, BrokenPipeError, OSError) as e:
-                    # اگر نوشتن شکست خورد (مثلاً socket بسته شده)، loop را exit کن
-                    print(f"[SIM] ⚠️ Write failed, connection closed: {e}")
-                    raise
+                    link.frame_ok()
+                    if msg_type in (MSG_TYPE_LINK_CAPS, MSG_TYPE_LINK_SWITCH):
+                        link.handle(msg_type, data)
+                    elif client is not None:
+                        scheduler.submit(client, msg_type, data)
+                    else:
+                        _dispatch_frame(out, msg_type, data)
+                out.flush()
+            except (ConnectionResetError, BrokenPipeError, OSError) as e:
+                # اگر خواندن/نوشتن شکست خورد (مثلاً socket بسته شده)، loop را exit کن
+                print(f"[SIM] ⚠️ Connection closed: {e}")
+                raise
             except Exception as e:
                 # خطاهای جزئی (مثلاً parsing) را لاگ کن ولی اتصال را نگه دار
                 print(f"[SIM] ⚠️ Error in loop (continuing): {e}")
@@ -398,6 +925,11 @@ def _run_simulator_loop(transport, label="Serial"):
     except KeyboardInterrupt:
         print("\n[SIM] Exiting.")
         raise
+    finally:
+        if client is not None:
+            scheduler.remove_client(client)
+            print(f"[SCHED] {client.report()}")
+        out.close()
 
 
 def run_simulator(port: str, baud: int = 9600):
@@ -419,61 +951,93 @@ def run_simulator(port: str, baud: int = 9600):
         ser.close()
 
 
-def run_simulator_tcp(tcp_port: int = 9999):
-    """Run simulator over TCP. One client. For tablet debug: adb reverse tcp:9999 tcp:9999, then app connects to 127.0.0.1:9999."""
+def _serve_tcp_client(conn, addr, scheduler, slots: threading.BoundedSemaphore):
+    name = f"{addr[0]}:{addr[1]}"
+    print(f"[SIM] Client connected from {addr}")
+    try:
+        _run_simulator_loop(_TcpTransport(conn), label=name, scheduler=scheduler)
+    except Exception as e:
+        print(f"[SIM] Error in simulator loop: {e}")
+    finally:
+        slots.release()
+        try:
+            conn.close()
+            print(f"[SIM] Connection {name} closed")
+        except Exception:
+            pass
+
+
+def _open_tcp_server(tcp_port: int):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
         server.bind(("0.0.0.0", tcp_port))
-        server.listen(1)
+        server.listen(MAX_TCP_CLIENTS)
         server.settimeout(1.0)
     except Exception as e:
         print(f"Error binding TCP port {tcp_port}: {e}")
         sys.exit(1)
+    return server
+
 
-    print(f"TCP simulator listening on 0.0.0.0:{tcp_port}")
+def _accept_tcp_clients(server, scheduler):
+    """Accept up to MAX_TCP_CLIENTS clients; each gets a reader thread feeding `scheduler` (_FairScheduler or _Gateway)."""
+    slots = threading.BoundedSemaphore(MAX_TCP_CLIENTS)
+    while True:
+        try:
+            conn, addr = server.accept()
+        except socket.timeout:
+            continue
+        if not slots.acquire(blocking=False):
+            print(f"[SIM] ⚠️ Rejecting {addr}: already {MAX_TCP_CLIENTS} clients")
+            conn.close()
+            continue
+        # فعال کردن keepalive برای جلوگیری از timeout
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # در ویندوز TCP_KEEPIDLE و TCP_KEEPINTVL ممکن است موجود نباشد
+        try:
+            # Linux: TCP_KEEPIDLE = 20, TCP_KEEPINTVL = 3
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 20)
+            if hasattr(socket, 'TCP_KEEPINTVL'):
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 3)
+        except Exception:
+            pass  # در ویندوز ممکن است موجود نباشد
+        threading.Thread(
+            target=_serve_tcp_client, args=(conn, addr, scheduler, slots), name=f"sim-client-{addr[1]}", daemon=True
+        ).start()
+
+
+def run_simulator_tcp(tcp_port: int = 9999, weight: float = 1.0, rate=None, overrides=None):
+    """
+    Run simulator over TCP. For tablet debug: adb reverse tcp:9999 tcp:9999, then app connects to 127.0.0.1:9999.
+    تا MAX_TCP_CLIENTS کلاینت هم‌زمان؛ فریم‌ها همه از یک کنترلر (worker) با _FairScheduler سرویس می‌گیرند.
+    weight/rate: وزن و محدودیت نرخ پیش‌فرض هر کلاینت؛ overrides: {ip: (weight, rate)}.
+    """
+    server = _open_tcp_server(tcp_port)
+    print(f"TCP simulator listening on 0.0.0.0:{tcp_port} (up to {MAX_TCP_CLIENTS} clients)")
     print("On laptop run: adb reverse tcp:9999 tcp:9999")
     print("Then in the app on tablet use 'Debug connection (tablet->laptop)'.")
     print("--- Data exchange log (RX = received, TX = sent) ---\n")
 
+    scheduler = _FairScheduler(weight=weight, rate=rate, overrides=overrides)
+    stop = threading.Event()
+    worker = threading.Thread(target=_controller_worker, args=(scheduler, stop), name="sim-controller", daemon=True)
+    worker.start()
     try:
-        while True:
-            try:
-                conn, addr = server.accept()
-            except socket.timeout:
-                continue
-            # فعال کردن keepalive برای جلوگیری از timeout
-            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            # در ویندوز TCP_KEEPIDLE و TCP_KEEPINTVL ممکن است موجود نباشد
-            try:
-                # Linux: TCP_KEEPIDLE = 20, TCP_KEEPINTVL = 3
-                if hasattr(socket, 'TCP_KEEPIDLE'):
-                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 20)
-                if hasattr(socket, 'TCP_KEEPINTVL'):
-                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 3)
-            except Exception:
-                pass  # در ویندوز ممکن است موجود نباشد
-            print(f"[SIM] Client connected from {addr}")
-            try:
-                _run_simulator_loop(_TcpTransport(conn))
-            except Exception as e:
-                print(f"[SIM] Error in simulator loop: {e}")
-            finally:
-                try:
-                    conn.close()
-                    print("[SIM] Connection closed, waiting for next client...")
-                except Exception:
-                    pass
+        _accept_tcp_clients(server, scheduler)
     except KeyboardInterrupt:
         print("\n[SIM] Exiting.")
     finally:
+        stop.set()
         server.close()
 
 
 # --- حالت ۲: کلاینت تست ---
 
 
-def read_response(ser, timeout_sec=2.0):
+def read_frame(ser, want, timeout_sec=2.0):
+    """Data of the first frame of type `want` ("ack" for ACK/NAK), or None on timeout."""
     buf = bytearray()
     deadline = time.monotonic() + timeout_sec
     while time.monotonic() < deadline:
@@ -485,15 +1049,60 @@ def read_response(ser, timeout_sec=2.0):
             if result is None:
                 break
             msg_type, data = result
-            if msg_type == "ack":
-                continue
-            if msg_type == MSG_TYPE_RESPONSE:
+            if msg_type == want or (want == "ack" and msg_type == "nak"):
                 return data
         time.sleep(0.02)
     return None
 
 
-def run_test_client(port: str, baud: int = 9600):
+def read_response(ser, timeout_sec=2.0):
+    return read_frame(ser, MSG_TYPE_RESPONSE, timeout_sec)
+
+
+def _probe_link(ser, timeout_sec: float) -> bool:
+    """Heartbeat until one is ACKed at the current rate."""
+    deadline = time.monotonic() + timeout_sec
+    while time.monotonic() < deadline:
+        ser.write(encode_frame(MSG_TYPE_HEARTBEAT, ""))
+        if read_frame(ser, "ack", 0.3) is not None:
+            return True
+    return False
+
+
+def negotiate_link(ser, bauds=SUPPORTED_BAUD_RATES, features=(), timeout_sec=2.0):
+    """
+    سمت کلاینت: تبادل CAPS، درخواست بالاترین نرخ مشترک و تأیید آن با heartbeat.
+    اگر با نرخ جدید ACK نیاید به DEFAULT_BAUD برمی‌گردد (میکرو هم بعد از LINK_SWITCH_TIMEOUT برمی‌گردد).
+    ser باید baudrate قابل تغییر داشته باشد (pyserial). برگشت: (baud نهایی، قابلیت‌های مشترک)
+    """
+    ser.write(encode_frame(MSG_TYPE_LINK_CAPS, encode_link_caps(bauds, features)))
+    reply = read_frame(ser, MSG_TYPE_LINK_CAPS, timeout_sec)
+    if reply is None:
+        # میکروی قدیمی بدون مذاکره
+        return ser.baudrate, []
+    peer_bauds, peer_features = parse_link_caps(reply)
+    common_features = [f for f in features if f in peer_features]
+    common = [b for b in bauds if b in peer_bauds]
+    target = max(common) if common else ser.baudrate
+    if target == ser.baudrate:
+        return target, common_features
+
+    ser.write(encode_frame(MSG_TYPE_LINK_SWITCH, str(target)))
+    if read_frame(ser, MSG_TYPE_LINK_SWITCH, timeout_sec) != str(target):
+        return ser.baudrate, common_features
+    ser.baudrate = target
+    if _probe_link(ser, LINK_SWITCH_TIMEOUT):
+        return target, common_features
+
+    print(f"   Link: no ACK at {target} baud, falling back to {DEFAULT_BAUD}")
+    ser.baudrate = DEFAULT_BAUD
+    # میکرو بعد از LINK_SWITCH_TIMEOUT خودش برمی‌گردد
+    if _probe_link(ser, LINK_SWITCH_TIMEOUT * 2):
+        return DEFAULT_BAUD, common_features
+    raise ConnectionError(f"link lost after switching to {target} baud")
+
+
+def run_test_client(port: str, baud: int = 9600, negotiate: bool = False):
     print(f"Connecting to {port} @ {baud} ...")
     try:
         ser = serial.Serial(port, baud, timeout=0.1)
@@ -505,6 +1114,16 @@ def run_test_client(port: str, baud: int = 9600):
     ok = 0
     fail = 0
 
+    if negotiate:
+        print("\n0. Link negotiation ...")
+        try:
+            link_baud, features = negotiate_link(ser)
+            print(f"   OK - Link at {link_baud} baud, common features: {features or '-'}")
+            ok += 1
+        except ConnectionError as e:
+            print(f"   FAIL - {e}")
+            fail += 1
+
     print("\n1. Request Floors (@M_F_A) ...")
     ser.write(encode_frame(MSG_TYPE_REQUEST, REQUEST_FLOORS))
     response = read_response(ser)
@@ -536,6 +1155,849 @@ def run_test_client(port: str, baud: int = 9600):
     sys.exit(0 if fail == 0 else 1)
 
 
+# --- حالت gateway: چند تبلت TCP روی یک خط سریال ---
+
+
+class _Gateway:
+    """
+    gateway بین چند کلاینت TCP و یک خط سریال به میکرو (واقعی یا شبیه‌ساز داخلی).
+    همان رابط _FairScheduler را برای _run_simulator_loop دارد؛ فریم‌ها با زمان‌بندی منصفانه یکی‌یکی روی خط می‌روند.
+    پروتکل شناسهٔ درخواست ندارد، پس هر فریم تا ACK/Response خودش خط را نگه می‌دارد و پاسخ به همان کلاینت (یا
+    کلاینت‌هایی که به آن پیوسته‌اند) برمی‌گردد.
+    - heartbeat کلاینت‌ها همین‌جا ACK می‌شود و به خط نمی‌رود، ولی فقط تا وقتی میکرو در GATEWAY_UPSTREAM_ALIVE ثانیهٔ اخیر
+      جواب داده است؛ وگرنه جوابی نمی‌گیرند تا قطع خط را مثل اتصال مستقیم تشخیص دهند. خط بیکار با heartbeat خود
+      gateway زنده نگه داشته می‌شود.
+    - خواندن‌های یکسانِ هم‌زمان (مثلاً چند تبلت با @M_F_A) یک درخواست روی خط می‌شوند.
+    - پاسخ خواندن تا cache_ttl ثانیه از cache داده می‌شود؛ هر دستور (&...) بعد از رسیدن به میکرو cache را باطل می‌کند.
+    - کلاینتی که دستورش هنوز جواب نگرفته نه از cache می‌خواند و نه به خواندن دیگران می‌پیوندد؛ خواندنش جدا
+      و بعد از دستور خودش روی خط می‌رود (read-your-write).
+    - فریم‌های PushState میکرو برای همهٔ کلاینت‌ها فرستاده می‌شوند.
+    - NAK میکرو به کلاینت(های) همان فریم می‌رسد؛ دستورِ NAK‌شده cache را باطل نمی‌کند.
+    """
+
+    def __init__(self, upstream, cache_ttl: float = GATEWAY_CACHE_TTL, **scheduler_options):
+        self._upstream = upstream
+        self._cache_ttl = cache_ttl
+        self._scheduler = _FairScheduler(**scheduler_options)
+        self._lock = threading.Lock()
+        self._clients = []
+        self._generation = 0  # بعد از رسیدن هر دستور به میکرو زیاد می‌شود؛ cache و ادغام فقط داخل یک generation
+        self._waiting = {}  # (data, generation, private) -> [clients] برای خواندن‌های در صف یا روی خط
+        self._owners = {}  # (data, generation, private) -> کلاینتی که درخواستش در scheduler است
+        self._writes = {}  # client -> تعداد دستورهای در صف یا روی خط
+        self._inflight = None  # کلیدی که الان روی خط است
+        self._last_rx = 0.0  # زمان monotonic آخرین بایت از میکرو
+        self._cache = {}  # data -> (expires_at, generation, response)
+        self._replies = queue.Queue()  # فریم‌های میکرو به‌جز PushState، از _read_upstream
+        self.counters = dict.fromkeys(
+            ("reads", "cache_hits", "collapsed", "upstream_reads", "upstream_commands", "upstream_timeouts", "upstream_naks", "pushes"),
+            0,
+        )
+
+    # رابط مورد استفادهٔ _run_simulator_loop
+
+    def add_client(self, name: str, out) -> _SchedClient:
+        client = self._scheduler.add_client(name, out)
+        with self._lock:
+            self._clients.append(client)
+        return client
+
+    def remove_client(self, client: _SchedClient):
+        resubmit = []
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+            self._writes.pop(client, None)
+            for key in list(self._waiting):
+                clients = self._waiting[key]
+                if client in clients:
+                    clients.remove(client)
+                if self._owners.get(key) is client and key != self._inflight:
+                    # درخواست این کلاینت با صفش حذف می‌شود؛ اگر کسی منتظر است به نام او دوباره در صف برود
+                    if clients:
+                        self._owners[key] = clients[0]
+                        resubmit.append((clients[0], key[0]))
+                    else:
+                        del self._waiting[key]
+                        del self._owners[key]
+        self._scheduler.remove_client(client)
+        for owner, data in resubmit:
+            self._scheduler.submit(owner, MSG_TYPE_REQUEST, data)
+
+    def wait_ready(self, client: _SchedClient, timeout: float):
+        self._scheduler.wait_ready(client, timeout)
+
+    def submit(self, client: _SchedClient, msg_type, data: str):
+        if msg_type == MSG_TYPE_HEARTBEAT:
+            if self.upstream_alive:
+                send_ack(client.out)
+            return
+        if msg_type != MSG_TYPE_REQUEST:
+            with self._lock:
+                self._writes[client] = self._writes.get(client, 0) + 1
+            self._scheduler.submit(client, msg_type, data)
+            return
+        with self._lock:
+            self.counters["reads"] += 1
+            # دستور خود این کلاینت هنوز به میکرو نرسیده: cache و خواندن‌های دیگران ممکن است دادهٔ قبل از آن باشند
+            private = client if self._writes.get(client) else None
+            cached = self._cache.get(data)
+            if private is None and cached is not None and cached[0] > time.monotonic() and cached[1] == self._generation:
+                self.counters["cache_hits"] += 1
+                send_ack(client.out)
+                client.out.write(encode_frame(MSG_TYPE_RESPONSE, cached[2]))
+                return
+            key = (data, self._generation, private)
+            if key in self._waiting:
+                self.counters["collapsed"] += 1
+                self._waiting[key].append(client)
+                return
+            self._waiting[key] = [client]
+            self._owners[key] = client
+        self._scheduler.submit(client, msg_type, data)
+
+    @property
+    def upstream_alive(self) -> bool:
+        return time.monotonic() - self._last_rx <= GATEWAY_UPSTREAM_ALIVE
+
+    def report(self):
+        c = self.counters
+        lines = self._scheduler.report()
+        lines.append(
+            f"gateway reads={c['reads']} cache_hits={c['cache_hits']} collapsed={c['collapsed']} "
+            f"upstream reads={c['upstream_reads']} commands={c['upstream_commands']} "
+            f"timeouts={c['upstream_timeouts']} naks={c['upstream_naks']} pushes={c['pushes']}"
+        )
+        return lines
+
+    # سمت خط سریال
+
+    def serve(self, stop: threading.Event):
+        """Upstream worker: one frame on the serial line at a time; stats every SCHED_REPORT_INTERVAL."""
+        threading.Thread(target=self._read_upstream, args=(stop,), name="gw-upstream-reader", daemon=True).start()
+        next_report = time.monotonic() + SCHED_REPORT_INTERVAL
+        was_alive = False
+        while not stop.is_set():
+            item = self._scheduler.next(0.2)
+            try:
+                if item is not None and item[1] == MSG_TYPE_REQUEST:
+                    self._forward_read(*item)
+                elif item is not None:
+                    self._forward_command(*item)
+                elif time.monotonic() - self._last_rx >= GATEWAY_UPSTREAM_HEARTBEAT:
+                    self._exchange(MSG_TYPE_HEARTBEAT, "", "ack")
+            except (ConnectionResetError, BrokenPipeError, OSError) as e:
+                print(f"[GW] ⚠️ Upstream write failed: {e}")
+                time.sleep(0.5)
+            if was_alive != self.upstream_alive:
+                was_alive = not was_alive
+                print(f"[GW] {'Upstream answering' if was_alive else '⚠️ Upstream silent; tablet heartbeats not answered'}")
+            if time.monotonic() >= next_report:
+                next_report = time.monotonic() + SCHED_REPORT_INTERVAL
+                for line in self.report():
+                    print(f"[GW] {line}")
+
+    def _forward_read(self, client: _SchedClient, msg_type, data: str):
+        with self._lock:
+            # کلیدِ همین آیتم: همان متن ممکن است در چند generation (قبل و بعد از یک دستور) در صف باشد
+            key = next((k for k in self._waiting if k[0] == data and self._owners.get(k) is client), None)
+            if key is None:
+                return  # همهٔ منتظرها قطع شده‌اند
+            self._inflight = key
+        self.counters["upstream_reads"] += 1
+        acked = set()
+
+        def ack_waiting():
+            # ACK میکرو همان لحظه به منتظرها می‌رسد، مثل اتصال مستقیم؛ پاسخ بعداً بدون ACK دوباره
+            with self._lock:
+                clients = list(self._waiting.get(key, []))
+            for waiting in clients:
+                self._deliver(waiting)
+                acked.add(waiting)
+
+        reply = self._exchange(msg_type, data, MSG_TYPE_RESPONSE, on_ack=ack_waiting)
+        response = reply[1] if reply is not None and reply[0] == MSG_TYPE_RESPONSE else None
+        with self._lock:
+            clients = self._waiting.pop(key, [])
+            self._owners.pop(key, None)
+            self._inflight = None
+            if response is not None and key[1] == self._generation and self._cache_ttl > 0:
+                self._cache[data] = (time.monotonic() + self._cache_ttl, key[1], response)
+        if reply is None:
+            self.counters["upstream_timeouts"] += 1
+            print(f"[GW] ⚠️ No response for {_req_name(data)}")
+            return  # مثل میکروی ساکت؛ timeout خود کلاینت‌ها عمل می‌کند
+        if reply[0] == "ack":
+            # درخواستی که میکرو فقط ACK می‌کند (مثلاً خواندن ناشناخته)
+            for waiting in clients:
+                if waiting not in acked:
+                    self._deliver(waiting)
+            return
+        if response is None:
+            self.counters["upstream_naks"] += 1
+            print(f"[GW] ⚠️ NAK for {_req_name(data)}")
+            for waiting in clients:
+                self._deliver_nak(waiting)
+            return
+        frame = encode_frame(MSG_TYPE_RESPONSE, response)
+        for waiting in clients:
+            self._deliver(waiting, frame, ack=waiting not in acked)
+
+    def _forward_command(self, client: _SchedClient, msg_type, data: str):
+        self.counters["upstream_commands"] += 1
+        reply = None
+        try:
+            reply = self._exchange(msg_type, data, "ack")
+        finally:
+            with self._lock:
+                if reply is None or reply[0] != "nak":
+                    # حتی بدون ACK ممکن است میکرو دستور را اجرا کرده باشد؛ فقط NAK یعنی چیزی عوض نشده
+                    self._generation += 1
+                    self._cache.clear()
+                if self._writes.get(client, 0) > 1:
+                    self._writes[client] -= 1
+                else:
+                    self._writes.pop(client, None)
+        if reply is None:
+            self.counters["upstream_timeouts"] += 1
+            print(f"[GW] ⚠️ No ACK for {_req_name(data)}")
+            return
+        if reply[0] == "nak":
+            self.counters["upstream_naks"] += 1
+            print(f"[GW] ⚠️ NAK for {_req_name(data)}")
+            self._deliver_nak(client)
+            return
+        self._deliver(client)
+
+    def _deliver(self, client: _SchedClient, *frames: bytes, ack: bool = True):
+        """ACK + frames to one client; a closed client must not stop the others."""
+        try:
+            if ack:
+                send_ack(client.out)
+            for frame in frames:
+                client.out.write(frame)
+            client.out.flush()
+        except (ConnectionResetError, BrokenPipeError, OSError) as e:
+            print(f"[GW] ⚠️ {client.name}: response dropped, connection closed: {e}")
+
+    def _deliver_nak(self, client: _SchedClient):
+        try:
+            send_nak(client.out)
+            client.out.flush()
+        except (ConnectionResetError, BrokenPipeError, OSError) as e:
+            print(f"[GW] ⚠️ {client.name}: NAK dropped, connection closed: {e}")
+
+    def _exchange(self, msg_type, data: str, want, on_ack=None):
+        """
+        Send one frame upstream and wait for `want` ("ack" or MSG_TYPE_RESPONSE).
+        برگشت: (want, data)، یا ("nak", "") اگر میکرو فریم را رد کند، یا None بعد از GATEWAY_UPSTREAM_TIMEOUT.
+        با want=MSG_TYPE_RESPONSE، on_ack با رسیدن ACK صدا زده می‌شود و اگر بعد از آن تا GATEWAY_ACK_ONLY_WINDOW
+        بایتی نرسد ("ack", "") برمی‌گردد تا خط منتظر پاسخی که نمی‌آید نماند.
+        """
+        while not self._replies.empty():
+            self._replies.get_nowait()  # پاسخ دیرِ یک فریم قبلی که timeout شده بود
+        self._upstream.write(encode_frame(msg_type, data))
+        deadline = time.monotonic() + GATEWAY_UPSTREAM_TIMEOUT
+        acked = False
+        while True:
+            now = time.monotonic()
+            remaining = deadline - now
+            if acked:
+                # پاسخ بزرگ با baud پایین طول می‌کشد؛ تا وقتی بایت می‌رسد صبر کن
+                remaining = min(remaining, self._last_rx + GATEWAY_ACK_ONLY_WINDOW - now)
+            if remaining <= 0:
+                return ("ack", "") if acked else None
+            try:
+                reply = self._replies.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if reply[0] in (want, "nak"):
+                return reply
+            if reply[0] == "ack" and not acked:
+                acked = True
+                if on_ack is not None:
+                    on_ack()
+
+    def _read_upstream(self, stop: threading.Event):
+        """Reader thread for the serial line: PushState goes to every client, everything else to _exchange."""
+        buf = bytearray()
+        waiting = hasattr(self._upstream, "in_waiting")
+        while not stop.is_set():
+            try:
+                if waiting:
+                    # pyserial: read(256) تا timeout منتظر ۲۵۶ بایت می‌ماند؛ فقط همان‌چه رسیده را بخوان
+                    chunk = self._upstream.read(max(1, min(256, self._upstream.in_waiting)))
+                else:
+                    chunk = self._upstream.read(256)
+            except (ConnectionResetError, BrokenPipeError, OSError) as e:
+                print(f"[GW] ⚠️ Upstream read failed: {e}")
+                time.sleep(0.5)
+                continue
+            if chunk:
+                self._last_rx = time.monotonic()
+                buf.extend(chunk)
+            while True:
+                result, buf = find_frame(buf)
+                if result is None:
+                    break
+                kind, payload = result
+                if kind != MSG_TYPE_PUSH_STATE:
+                    self._replies.put(result)
+                    continue
+                self.counters["pushes"] += 1
+                frame = encode_frame(MSG_TYPE_PUSH_STATE, payload)
+                with self._lock:
+                    clients = list(self._clients)
+                for client in clients:
+                    try:
+                        client.out.write(frame)
+                        client.out.flush()
+                    except (ConnectionResetError, BrokenPipeError, OSError):
+                        pass  # این کلاینت در حال قطع شدن است
+
+
+def _start_simulated_upstream():
+    """In-process simulator on one end of a socketpair; returns the gateway's end."""
+    sim_sock, gateway_sock = socket.socketpair()
+
+    def serve():
+        try:
+            _run_simulator_loop(_TcpTransport(sim_sock), label="upstream")
+        except Exception:
+            pass
+
+    threading.Thread(target=serve, name="sim-upstream", daemon=True).start()
+    return _TcpTransport(gateway_sock)
+
+
+def run_gateway(tcp_port: int = 9999, port=None, baud: int = DEFAULT_BAUD, negotiate: bool = False, cache_ttl=GATEWAY_CACHE_TTL, **scheduler_options):
+    """
+    Gateway: many TCP tablets, one serial line. port=None → in-process simulator instead of a serial port.
+    """
+    if port is None:
+        upstream = _start_simulated_upstream()
+        print("Gateway upstream: built-in simulator")
+    else:
+        print(f"Opening {port} @ {baud} ...")
+        try:
+            upstream = serial.Serial(port, baud, timeout=0.1)
+        except Exception as e:
+            print(f"Error opening port: {e}")
+            sys.exit(1)
+        if negotiate:
+            link_baud, features = negotiate_link(upstream)
+            print(f"Gateway upstream link at {link_baud} baud, common features: {features or '-'}")
+
+    server = _open_tcp_server(tcp_port)
+    print(f"Gateway listening on 0.0.0.0:{tcp_port} (up to {MAX_TCP_CLIENTS} clients), read cache TTL {cache_ttl:g}s")
+    print("--- Data exchange log (RX = received from tablets) ---\n")
+
+    gateway = _Gateway(upstream, cache_ttl=cache_ttl, **scheduler_options)
+    stop = threading.Event()
+    threading.Thread(target=gateway.serve, args=(stop,), name="gw-upstream", daemon=True).start()
+    try:
+        _accept_tcp_clients(server, gateway)
+    except KeyboardInterrupt:
+        print("\n[GW] Exiting.")
+    finally:
+        stop.set()
+        server.close()
+        if port is not None:
+            upstream.close()
+
+
+# --- بنچمارک مسیر نوشتن ---
+
+
+class _CountingSocket:
+    """Socket wrapper that counts the send syscalls (sendall/sendmsg/send) actually issued."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.send_calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._sock, name)  # sendmsg فقط اگر socket واقعی داشته باشد (نه در ویندوز)
+        if name not in ("sendall", "sendmsg", "send"):
+            return attr
+
+        def counted(*args):
+            self.send_calls += 1
+            return attr(*args)
+
+        return counted
+
+
+class _BenchTransport(_TcpTransport):
+    """_TcpTransport that counts socket send calls and, with baud set, delivers each write only after the time its bytes take on a serial line."""
+
+    def __init__(self, sock, baud=None):
+        super().__init__(_CountingSocket(sock))
+        self.baud = baud
+        self.read_log = []  # (زمان monotonic، بایت‌ها) برای هر read غیرخالی
+
+    def _line_delay(self, nbytes: int):
+        if self.baud:
+            time.sleep(nbytes * 10 / self.baud)  # 8N1 = ۱۰ بیت برای هر بایت
+
+    @property
+    def send_calls(self) -> int:
+        return self._sock.send_calls
+
+    def write(self, data: bytes):
+        self._line_delay(len(data))
+        super().write(data)
+
+    def writev(self, chunks):
+        self._line_delay(sum(len(c) for c in chunks))
+        super().writev(chunks)
+
+    def read(self, size: int = 256) -> bytes:
+        data = super().read(size)
+        self.read_log.append((time.monotonic(), data))
+        return data
+
+
+class _BenchClient:
+    """Test-client side of a socketpair: send frames, wait for ACK/RESPONSE with a persistent buffer."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._sock.settimeout(0.1)
+        self._buf = bytearray()
+
+    def send(self, *frames: bytes):
+        self._sock.sendall(b"".join(frames))
+
+    def wait(self, kind, timeout_sec=3.0):
+        deadline = time.monotonic() + timeout_sec
+        while time.monotonic() < deadline:
+            while True:
+                result, self._buf = find_frame(self._buf)
+                if result is None:
+                    break
+                if result[0] == kind:
+                    return result[1]
+            try:
+                self._buf.extend(self._sock.recv(4096))
+            except socket.timeout:
+                pass
+        raise TimeoutError(f"no {kind!r} frame within {timeout_sec}s")
+
+
+def _bench_session(writer: str, requests: int, baud: int):
+    server_sock, client_sock = socket.socketpair()
+    transport = _BenchTransport(server_sock)
+    client = _BenchClient(client_sock)
+
+    def serve():
+        try:
+            _run_simulator_loop(transport, label="bench", writer=writer)
+        except Exception:
+            pass
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    result = {}
+    try:
+        # ۱) write در هر درخواست (ترتیبی، بدون تأخیر خط)
+        cycle = [
+            (MSG_TYPE_REQUEST, REQUEST_FLOORS_COUNT, MSG_TYPE_RESPONSE),
+            (MSG_TYPE_REQUEST, REQUEST_FLOORS, MSG_TYPE_RESPONSE),
+            (MSG_TYPE_REQUEST, REQUEST_ROOMS, MSG_TYPE_RESPONSE),
+            (MSG_TYPE_HEARTBEAT, "", "ack"),
+        ]
+        for i in range(requests):
+            msg_type, data, want = cycle[i % len(cycle)]
+            client.send(encode_frame(msg_type, data))
+            client.wait(want)
+        result["writes_per_request"] = transport.send_calls / requests
+
+        # ۲) چند درخواست پشت‌سرهم در یک ارسال
+        before = transport.send_calls
+        burst = 8
+        for _ in range(requests // burst):
+            client.send(*[encode_frame(MSG_TYPE_REQUEST, REQUEST_FLOORS_COUNT)] * burst)
+            for _ in range(burst):
+                client.wait(MSG_TYPE_RESPONSE)
+        result["writes_per_request_pipelined"] = (transport.send_calls - before) / (requests // burst * burst)
+
+        # ۳) تأخیر ورودی: heartbeat در حین تخلیهٔ پاسخ بزرگ @M_R روی خط با baud شبیه‌سازی‌شده
+        transport.baud = baud
+        latencies = []
+        for _ in range(5):
+            client.send(encode_frame(MSG_TYPE_REQUEST, REQUEST_ROOMS))
+            time.sleep(0.05)  # شبیه‌ساز درخواست را خوانده و نوشتن پاسخ شروع شده
+            sent_at = time.monotonic()
+            client.send(encode_frame(MSG_TYPE_HEARTBEAT, ""))
+            client.wait(MSG_TYPE_RESPONSE)
+            client.wait("ack")
+            seen = [t for t, data in transport.read_log if t >= sent_at and data]
+            latencies.append((seen[0] - sent_at) * 1000 if seen else float("nan"))
+        transport.baud = None
+        result["input_latency_ms"] = sum(latencies) / len(latencies)
+        result["input_latency_max_ms"] = max(latencies)
+    finally:
+        client_sock.close()
+        thread.join(2.0)
+        server_sock.close()
+    return result
+
+
+def run_write_path_benchmark(requests: int = 200, baud: int = 9600):
+    """Compare per-frame (old), inline-batched and queued (writer thread) output: send syscalls per request and input latency."""
+    print(f"Write-path benchmark: {requests} requests, large response (@M_R) drained at {baud} baud\n")
+    rows = []
+    modes = (
+        ("per-frame (before queue)", "frame"),
+        ("inline (blocking write)", "inline"),
+        ("queued (writer thread)", "thread"),
+    )
+    for label, writer in modes:
+        # لاگ RX/TX شبیه‌ساز در بنچمارک چاپ نشود
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = _bench_session(writer, requests, baud)
+        rows.append((label, result))
+    print(f"{'mode':<26}{'sends/req':>12}{'pipelined':>12}{'input lat ms':>15}{'max ms':>10}")
+    for label, r in rows:
+        print(
+            f"{label:<26}{r['writes_per_request']:>12.2f}{r['writes_per_request_pipelined']:>12.2f}"
+            f"{r['input_latency_ms']:>15.1f}{r['input_latency_max_ms']:>10.1f}"
+        )
+    print("\n(sends/req = تعداد sendall/sendmsg واقعی روی socket)")
+
+
+def _fairness_session(duration: float, tablets: int, rate, service_time: float):
+    scheduler = _FairScheduler(overrides={"provisioner": (1.0, rate)})
+    stop = threading.Event()
+    threads = [threading.Thread(target=_controller_worker, args=(scheduler, stop, service_time), daemon=True)]
+    sockets = []
+
+    def connect(name):
+        server_sock, client_sock = socket.socketpair()
+        sockets.extend((server_sock, client_sock))
+
+        def serve():
+            try:
+                _run_simulator_loop(_TcpTransport(server_sock), label=name, scheduler=scheduler)
+            except Exception:
+                pass
+
+        threads.append(threading.Thread(target=serve, daemon=True))
+        return _BenchClient(client_sock)
+
+    commands = [0]
+    rtts = {f"tablet-{i + 1}": ([], []) for i in range(tablets)}  # (heartbeat, @M_F_A) بر حسب ms
+
+    def provisioner(client):
+        # مثل room_setup_flow: دستورات &M_R_U پشت‌سرهم، هر بار ۸ تا بدون انتظار بینشان
+        frame = encode_frame(MSG_TYPE_COMMAND, f"{COMMAND_UPDATE_ROOM}{RECORD_SEP}{_room_to_line(ROOMS_LIST[1])}")
+        try:
+            while not stop.is_set():
+                client.send(*[frame] * 8)
+                for _ in range(8):
+                    client.wait("ack", timeout_sec=30)
+                commands[0] += 8
+        except (OSError, TimeoutError):
+            pass  # پایان بنچمارک و بسته شدن socket
+
+    def tablet(client, name):
+        heartbeats, reads = rtts[name]
+        i = 0
+        try:
+            while not stop.is_set():
+                sent_at = time.monotonic()
+                if i % 5 == 0:
+                    client.send(encode_frame(MSG_TYPE_REQUEST, REQUEST_FLOORS))
+                    client.wait(MSG_TYPE_RESPONSE)
+                    reads.append((time.monotonic() - sent_at) * 1000)
+                else:
+                    client.send(encode_frame(MSG_TYPE_HEARTBEAT, ""))
+                    client.wait("ack")
+                    heartbeats.append((time.monotonic() - sent_at) * 1000)
+                i += 1
+                time.sleep(0.1)
+        except (OSError, TimeoutError):
+            pass
+
+    load = [threading.Thread(target=provisioner, args=(connect("provisioner"),), daemon=True)]
+    for name in rtts:
+        load.append(threading.Thread(target=tablet, args=(connect(name), name), daemon=True))
+    for t in threads + load:
+        t.start()
+    time.sleep(duration)
+    report = scheduler.report()
+    stop.set()
+    for t in load:
+        t.join(2.0)
+    for sock in sockets:
+        sock.close()
+    for t in threads:
+        t.join(2.0)  # لاگ قطع اتصال هنوز داخل redirect_stdout چاپ شود
+    return report, rtts, commands[0] / duration
+
+
+def run_fairness_benchmark(duration: float = 5.0, tablets: int = 3, rate: float = 20.0, service_time: float = 0.01):
+    """One provisioner floods &M_R_U while tablets send heartbeats and @M_F_A; report scheduler stats and tablet round trips."""
+    print(f"Fairness benchmark: 1 provisioner + {tablets} tablets, {duration:.0f}s per run, controller {service_time * 1000:.0f}ms/frame\n")
+    for label, provisioner_rate in (("no rate limit", None), (f"provisioner limited to {rate:g}/s", rate)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            report, rtts, commands_per_sec = _fairness_session(duration, tablets, provisioner_rate, service_time)
+        print(f"--- {label}: provisioner {commands_per_sec:.0f} commands/s ---")
+        for line in report:
+            print(f"[SCHED] {line}")
+        for name, (heartbeats, reads) in rtts.items():
+            hb = f"{sum(heartbeats) / len(heartbeats):.1f}/{max(heartbeats):.1f}" if heartbeats else "-"
+            rd = f"{sum(reads) / len(reads):.1f}/{max(reads):.1f}" if reads else "-"
+            print(f"{name}: heartbeat avg/max {hb} ms, @M_F_A avg/max {rd} ms")
+        print()
+
+
+def _start_gateway_bench(tablets: int, cache_ttl: float, baud: int):
+    """Simulator on an emulated line behind a gateway, with `tablets` socketpair clients; returns (gateway, clients, stop_all)."""
+    sim_sock, gateway_sock = socket.socketpair()
+    sim_transport = _BenchTransport(sim_sock, baud)
+    upstream = _BenchTransport(gateway_sock, baud)
+    gateway = _Gateway(upstream, cache_ttl=cache_ttl)
+    stop = threading.Event()
+    sockets = [sim_sock, gateway_sock]
+
+    def serve(transport, **kwargs):
+        try:
+            _run_simulator_loop(transport, **kwargs)
+        except Exception:
+            pass
+
+    threads = [
+        threading.Thread(target=serve, args=(sim_transport,), kwargs={"label": "upstream"}, daemon=True),
+        threading.Thread(target=gateway.serve, args=(stop,), daemon=True),
+    ]
+    clients = []
+    for i in range(tablets):
+        server_sock, client_sock = socket.socketpair()
+        sockets.extend((server_sock, client_sock))
+        threads.append(
+            threading.Thread(
+                target=serve, args=(_TcpTransport(server_sock),), kwargs={"label": f"tablet-{i + 1}", "scheduler": gateway}, daemon=True
+            )
+        )
+        clients.append(_BenchClient(client_sock))
+    for t in threads:
+        t.start()
+
+    def stop_all():
+        stop.set()
+        for sock in sockets:
+            sock.close()
+        for t in threads:
+            t.join(2.0)  # لاگ قطع اتصال هنوز داخل redirect_stdout چاپ شود
+
+    return gateway, clients, stop_all
+
+
+def _gateway_session(tablets: int, rounds: int, cache_ttl: float, baud: int):
+    gateway, clients, stop_all = _start_gateway_bench(tablets, cache_ttl, baud)
+
+    # همهٔ تبلت‌ها هر دور هم‌زمان @M_F_A می‌پرسند
+    barrier = threading.Barrier(tablets)
+    latencies = []
+
+    def tablet(client):
+        try:
+            for _ in range(rounds):
+                barrier.wait()
+                sent_at = time.monotonic()
+                client.send(encode_frame(MSG_TYPE_REQUEST, REQUEST_FLOORS))
+                client.wait(MSG_TYPE_RESPONSE, timeout_sec=10)
+                latencies.append((time.monotonic() - sent_at) * 1000)
+                time.sleep(0.3)
+        except (OSError, TimeoutError, threading.BrokenBarrierError):
+            barrier.abort()
+
+    load = [threading.Thread(target=tablet, args=(client,), daemon=True) for client in clients]
+    for t in load:
+        t.start()
+    for t in load:
+        t.join(rounds * 15)
+    stop_all()
+    return gateway.counters, latencies
+
+
+def _gateway_read_your_write_session(trials: int, baud: int):
+    """
+    تبلت A یک طبقه می‌سازد و بلافاصله @M_F_A می‌خواند، در حالی که B همان خواندن را در صف دارد و C خط را با @M_R
+    مشغول کرده است. خواندن A باید طبقهٔ خودش را ببیند (نه پاسخ ادغام‌شده یا cache قبل از دستور). برگشت: تعداد موفق
+    """
+    saved = list(FLOORS_LIST)
+    gateway, (writer, reader, busy), stop_all = _start_gateway_bench(3, GATEWAY_CACHE_TTL, baud)
+    seen = 0
+    try:
+        for i in range(trials):
+            floor_id = f"rw-{i}"
+            reader.send(encode_frame(MSG_TYPE_REQUEST, REQUEST_FLOORS))
+            reader.wait(MSG_TYPE_RESPONSE, timeout_sec=10)  # cache پر است
+            busy.send(encode_frame(MSG_TYPE_REQUEST, REQUEST_ROOMS))
+            time.sleep(0.02)
+            writer.send(encode_frame(MSG_TYPE_COMMAND, f"{COMMAND_CREATE_FLOOR}{RECORD_SEP}{floor_id}|RW {i}|{90 + i}|"))
+            time.sleep(0.01)
+            reader.send(encode_frame(MSG_TYPE_REQUEST, REQUEST_FLOORS))
+            time.sleep(0.01)
+            writer.send(encode_frame(MSG_TYPE_REQUEST, REQUEST_FLOORS))
+            response = writer.wait(MSG_TYPE_RESPONSE, timeout_sec=10)
+            if any(line.split(FIELD_SEP)[0] == floor_id for line in response.split(RECORD_SEP)):
+                seen += 1
+            reader.wait(MSG_TYPE_RESPONSE, timeout_sec=10)
+            busy.wait(MSG_TYPE_RESPONSE, timeout_sec=10)
+    finally:
+        stop_all()
+        FLOORS_LIST[:] = saved
+    return seen
+
+
+def run_gateway_benchmark(tablets: int = 6, rounds: int = 10, baud: int = DEFAULT_BAUD):
+    """Tablets ask @M_F_A at the same moment through the gateway; count what crosses the (emulated) serial line."""
+    print(f"Gateway benchmark: {tablets} tablets x {rounds} rounds of simultaneous @M_F_A, upstream line {baud} baud\n")
+    print(f"{'cache TTL':>10}{'reads':>8}{'on line':>9}{'collapsed':>11}{'cache hits':>12}{'lat avg ms':>12}{'max ms':>9}")
+    for cache_ttl in (0.0, GATEWAY_CACHE_TTL):
+        with contextlib.redirect_stdout(io.StringIO()):
+            counters, latencies = _gateway_session(tablets, rounds, cache_ttl, baud)
+        avg = sum(latencies) / len(latencies) if latencies else float("nan")
+        print(
+            f"{cache_ttl:>9g}s{counters['reads']:>8}{counters['upstream_reads']:>9}{counters['collapsed']:>11}"
+            f"{counters['cache_hits']:>12}{avg:>12.1f}{max(latencies, default=float('nan')):>9.1f}"
+        )
+    print(f"\n(بدون gateway هر {tablets * rounds} خواندن جداگانه روی خط سریال می‌رفت)")
+
+    trials = 5
+    with contextlib.redirect_stdout(io.StringIO()):
+        seen = _gateway_read_your_write_session(trials, baud)
+    result = "OK" if seen == trials else "FAIL"
+    print(f"\nRead-your-write (command then @M_F_A while another tablet's read is queued): {seen}/{trials} {result}")
+
+
+class _EmulatedLine:
+    """
+    خط سریال شبیه‌سازی‌شده روی یک جفت pty.
+    بایت‌ها فقط وقتی سالم می‌رسند که هر دو سر روی یک baud باشند و آن baud از max_baud (سقف کابل/مبدل) بیشتر نباشد؛
+    هر write به اندازهٔ زمان ارسال بایت‌ها با baud فعلی طول می‌کشد.
+    """
+
+    def __init__(self, max_baud=None):
+        self.max_baud = max_baud
+        self.ends = []
+
+    def end(self, read_fn, write_fn, flush_fn=None, set_baud=None):
+        end = _EmulatedEnd(self, read_fn, write_fn, flush_fn, set_baud)
+        self.ends.append(end)
+        return end
+
+
+class _EmulatedEnd:
+    """One side of an _EmulatedLine with the read/write/flush/baudrate surface of a pyserial port."""
+
+    def __init__(self, line, read_fn, write_fn, flush_fn, set_baud):
+        self._line = line
+        self._read = read_fn
+        self._write = write_fn
+        self._flush = flush_fn
+        self._set_baud = set_baud
+        self._baud = DEFAULT_BAUD
+
+    @property
+    def baudrate(self) -> int:
+        return self._baud
+
+    @baudrate.setter
+    def baudrate(self, baud: int):
+        self._baud = baud
+        if self._set_baud is not None:
+            self._set_baud(baud)
+
+    def write(self, data: bytes):
+        peer = next(e for e in self._line.ends if e is not self)
+        max_baud = self._line.max_baud
+        if self._baud != peer.baudrate or (max_baud is not None and self._baud > max_baud):
+            # نرخ نامشترک یا بالاتر از توان خط: گیرنده فقط بایت خراب می‌بیند
+            data = bytes(b ^ 0x5A for b in data)
+        time.sleep(len(data) * 10 / self._baud)  # 8N1: بایت‌ها بعد از زمان ارسالشان می‌رسند
+        self._write(data)
+
+    def read(self, size: int = 256) -> bytes:
+        return self._read(size)
+
+    def flush(self):
+        if self._flush is not None:
+            self._flush()
+
+
+def _link_bench_session(client_bauds, max_baud, transfers: int):
+    """Negotiate over a fresh pty pair, then time `transfers` @M_R round trips. Returns (baud, seconds per transfer)."""
+    master, slave = os.openpty()
+    ser = serial.Serial(os.ttyname(slave), DEFAULT_BAUD, timeout=0.1)
+
+    def master_read(size):
+        ready, _, _ = select.select([master], [], [], 0.1)
+        return os.read(master, size) if ready else b""
+
+    def sim_read(size):
+        # فقط همان‌چه رسیده؛ read(256) خالص تا timeout منتظر ۲۵۶ بایت می‌ماند و زمان خط را می‌پوشاند
+        return ser.read(max(1, min(size, ser.in_waiting)))
+
+    line = _EmulatedLine(max_baud)
+    sim_end = line.end(sim_read, ser.write, ser.flush, lambda baud: setattr(ser, "baudrate", baud))
+    client_end = line.end(master_read, lambda data: os.write(master, data))
+
+    def serve():
+        try:
+            _run_simulator_loop(sim_end)
+        except Exception:
+            pass
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    try:
+        baud, features = negotiate_link(client_end, client_bauds)
+        started = time.monotonic()
+        for _ in range(transfers):
+            client_end.write(encode_frame(MSG_TYPE_REQUEST, REQUEST_ROOMS))
+            if read_response(client_end) is None:
+                raise ConnectionError(f"no @M_R response at {baud} baud")
+        return baud, features, (time.monotonic() - started) / transfers
+    finally:
+        os.close(master)
+        ser.close()
+        os.close(slave)
+        thread.join(2.0)
+
+
+def run_link_benchmark(transfers: int = 5):
+    """Negotiate each supported rate over a pty pair with the line rate emulated and report @M_R transfer time."""
+    if not hasattr(os, "openpty"):
+        print("--bench-baud needs a pty pair (Linux/macOS).")
+        sys.exit(1)
+    frame_bytes = len(encode_frame(MSG_TYPE_RESPONSE, get_rooms_text())) + 3  # + ACK
+    print(f"Link benchmark: {transfers} x @M_R ({frame_bytes} bytes back) per rate, pty pair with emulated line rate\n")
+    print(f"{'offered':>10}{'negotiated':>12}{'ms/transfer':>14}{'bytes/s':>10}  features")
+    for baud in SUPPORTED_BAUD_RATES:
+        with contextlib.redirect_stdout(io.StringIO()):
+            negotiated, features, seconds = _link_bench_session((DEFAULT_BAUD, baud), None, transfers)
+        print(
+            f"{baud:>10}{negotiated:>12}{seconds * 1000:>14.1f}{frame_bytes / seconds:>10.0f}"
+            f"  {LIST_SEP.join(features) or '-'}"
+        )
+
+    # کابلی که بیشتر از 57600 را تحمل نمی‌کند: تغییر به 115200 شکست می‌خورد و هر دو سر به 9600 برمی‌گردند
+    started = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        negotiated, _, seconds = _link_bench_session(SUPPORTED_BAUD_RATES, 57600, transfers)
+    result = "OK" if negotiated == DEFAULT_BAUD else f"FAIL (ended at {negotiated})"
+    print(
+        f"\nFallback (line max 57600, switch to {max(SUPPORTED_BAUD_RATES)}): {result}, "
+        f"back at {negotiated} baud after {time.monotonic() - started - seconds * transfers:.1f}s, "
+        f"{seconds * 1000:.1f} ms/transfer"
+    )
+
+
 # --- لیست پورت‌ها ---
 
 
@@ -556,22 +2018,99 @@ def list_serial_ports():
 # --- main ---
 
 
+def _pop_option(args, name: str):
+    """Remove every `name VALUE` pair from args and return the values."""
+    values = []
+    while name in args:
+        i = args.index(name)
+        args.pop(i)
+        if i < len(args):
+            values.append(args.pop(i))
+    return values
+
+
+def _positive(value: str, option: str) -> float:
+    try:
+        number = float(value)
+    except ValueError:
+        number = 0.0
+    if number <= 0:
+        print(f"{option}: expected a number > 0, got {value!r}")
+        sys.exit(1)
+    return number
+
+
+def _pop_scheduler_options(args):
+    """--rate, --weight and --client IP=WEIGHT[:RATE] as _FairScheduler keyword arguments."""
+    rate = _pop_option(args, "--rate")
+    weight = _pop_option(args, "--weight")
+    overrides = {}
+    for spec in _pop_option(args, "--client"):
+        ip, _, value = spec.partition("=")
+        client_weight, _, client_rate = value.partition(":")
+        overrides[ip] = (
+            _positive(client_weight or "1", f"--client {spec}"),
+            _positive(client_rate, f"--client {spec}") if client_rate else None,
+        )
+    return {
+        "weight": _positive(weight[-1], "--weight") if weight else 1.0,
+        "rate": _positive(rate[-1], "--rate") if rate else None,
+        "overrides": overrides,
+    }
+
+
 def main():
     args = sys.argv[1:]
+    baud = _pop_option(args, "--baud")
+    baud = int(baud[-1]) if baud else DEFAULT_BAUD
+    negotiate = "--negotiate" in args
+    args = [a for a in args if a != "--negotiate"]
     if args and args[0] == "--list":
         list_serial_ports()
         sys.exit(0)
     if args and args[0] == "--test":
         args.pop(0)
         port = args[0] if args else "COM6"
-        run_test_client(port)
+        run_test_client(port, baud, negotiate)
     elif args and args[0] == "--tcp":
         args.pop(0)
+        scheduler_options = _pop_scheduler_options(args)
         tcp_port = int(args[0]) if args else 9999
-        run_simulator_tcp(tcp_port)
+        run_simulator_tcp(tcp_port, **scheduler_options)
+    elif args and args[0] == "--gateway":
+        # --gateway [TCP_PORT] [SERIAL_PORT]؛ بدون پورت سریال، شبیه‌ساز داخلی پشت gateway است
+        args.pop(0)
+        cache_ttl = _pop_option(args, "--cache-ttl")
+        scheduler_options = _pop_scheduler_options(args)
+        tcp_port = int(args.pop(0)) if args and args[0].isdigit() else 9999
+        port = args[0] if args else None
+        run_gateway(
+            tcp_port,
+            port,
+            baud,
+            negotiate,
+            cache_ttl=float(cache_ttl[-1]) if cache_ttl else GATEWAY_CACHE_TTL,
+            **scheduler_options,
+        )
+    elif args and args[0] == "--bench-gateway":
+        args.pop(0)
+        tablets = int(args[0]) if args else 6
+        run_gateway_benchmark(tablets)
+    elif args and args[0] == "--bench-fair":
+        args.pop(0)
+        duration = float(args[0]) if args else 5.0
+        run_fairness_benchmark(duration)
+    elif args and args[0] == "--bench-baud":
+        args.pop(0)
+        transfers = int(args[0]) if args else 5
+        run_link_benchmark(transfers)
+    elif args and args[0] == "--bench":
+        args.pop(0)
+        requests = int(args[0]) if args else 200
+        run_write_path_benchmark(requests)
     else:
         port = args[0] if args else "COM5"
-        run_simulator(port)
+        run_simulator(port, baud)
 
 
 if __name__ == "__main__":